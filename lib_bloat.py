@@ -6,123 +6,582 @@
 # with mangled names. That means linking with -g or --profiling-funcs, and with
 # -Wl,--no-demangle
 
+# Function and data segment sizes are read from the wasm file's name section
+# directly. bloaty is only used as a fallback if there is no name section.
+
 # This script tracks weak symbols separately from defined functions. This is
 # weak symbols are not attributable to only one object file, and removing
 # the entire object from the link would not remove the weak symbol from the
 # final linked output unless that object is the only one defining the symbol.
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import dataclasses
+import hashlib
+import mmap
 import operator
 import os
 from pathlib import Path
+import pickle
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 LLVM_DIR = Path('/s/emr/install/bin')
 BLOATY_DIR = Path.home() / 'software' / 'bloaty'
 VERBOSE = False
+# Run a separate llvm-nm for each lib, concurrently, instead of one llvm-nm
+# invocation for all of them. This may be slower where process creation is
+# expensive (e.g. on Windows).
+PARALLEL_NM = False
+# Tool output is also cached on disk across runs, keyed by the path, mtime and
+# size of each file argument (including the tool itself).
+USE_DISK_CACHE = True
+CACHE_DIR = Path.home() / '.cache' / 'lib_bloat'
+# Bump this when the format of cached values changes. Values are only builtin
+# types, so that they can be loaded whether this file was run as a script
+# (__main__) or imported as a module.
+CACHE_VERSION = 4
+# Disk cache entries that have not been used for this long are dropped.
+CACHE_MAX_AGE = 14 * 24 * 60 * 60
 
 tool_output_cache = {}
-def run_tool(cmd):
+# Guards tool_output_cache when tools are run from multiple threads.
+cache_lock = threading.Lock()
+disk_cache_dir = None
+
+# Turns the disk cache off for the rest of the run, e.g. if the home directory
+# isn't writable. The cache is only an optimization, so this isn't fatal.
+def DisableDiskCache(error):
+    global USE_DISK_CACHE
+    if USE_DISK_CACHE:
+        print(f'warning: disabling disk cache: {error}')
+        USE_DISK_CACHE = False
+
+
+# Each disk cache entry is a separate file, named by a hash of its key. Its mtime
+# is updated whenever it is used, so evicting old entries only needs a scan of
+# the directory, and evicted entries don't leave any garbage behind. Returns
+# None if the disk cache can't be used.
+def GetDiskCacheDir():
+    global disk_cache_dir
+    if not USE_DISK_CACHE:
+        return None
+    if disk_cache_dir is None:
+        cache_dir = CACHE_DIR / f'v{CACHE_VERSION}'
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            entries = list(os.scandir(cache_dir))
+        except OSError as e:
+            DisableDiskCache(e)
+            return None
+        cutoff = time.time() - CACHE_MAX_AGE
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except OSError:
+                pass # Removed concurrently by another run.
+        disk_cache_dir = cache_dir
+    return disk_cache_dir
+
+
+# Returns the value cached under key, or None.
+def ReadDiskCache(key):
+    cache_dir = GetDiskCacheDir()
+    if cache_dir is None:
+        return None
+    path = cache_dir / hashlib.sha256(key.encode()).hexdigest()
+    try:
+        with open(path, 'rb') as f:
+            stored_key, value = pickle.load(f)
+        os.utime(path)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    # The key is stored too, in case of a hash collision.
+    return value if stored_key == key else None
+
+
+def WriteDiskCache(key, value):
+    cache_dir = GetDiskCacheDir()
+    if cache_dir is None:
+        return
+    path = cache_dir / hashlib.sha256(key.encode()).hexdigest()
+    # Write to a temporary file and rename it, so that concurrent runs never
+    # see a partially written entry.
+    temp_name = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+            temp_name = f.name
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_name, path)
+    except OSError as e:
+        if temp_name is not None:
+            try:
+                os.unlink(temp_name)
+            except OSError:
+                pass
+        DisableDiskCache(e)
+
+
+def GetDiskCacheKey(cmd):
+    key = []
+    for arg in cmd:
+        if isinstance(arg, Path):
+            try:
+                st = arg.stat()
+            except OSError:
+                return None # Let the tool report the missing file.
+            key.append((str(arg.resolve()), st.st_mtime_ns, st.st_size))
+        else:
+            key.append(arg)
+    return repr(key)
+
+
+# Runs cmd and yields the lines of its output as they are read from the pipe
+# (including line endings), so that callers can parse the output while the tool
+# is running. With cache=False the output is neither looked up in nor stored in
+# either cache, and isn't kept in memory.
+def iter_tool_lines(cmd, cache=True):
     cmd_str = repr(cmd)
-    if cmd_str in tool_output_cache:
-        return tool_output_cache[cmd_str]
+    disk_key = GetDiskCacheKey(cmd) if USE_DISK_CACHE and cache else None
+    with cache_lock:
+        lines = tool_output_cache.get(cmd_str) if cache else None
+    if lines is None and disk_key is not None:
+        lines = ReadDiskCache(disk_key)
+        if lines is not None:
+            with cache_lock:
+                tool_output_cache[cmd_str] = lines
+    if lines is not None:
+        yield from lines
+        return
     if VERBOSE:
         print(' '.join([str(p) for p in cmd]))
 
-    result = subprocess.run(cmd, capture_output=True)
-    if result.returncode:
-        print(f'Command Failed:')
-        print(' '.join([str(p) for p in cmd]))
-        print(result.stdout.decode())
-        print(result.stderr.decode())
-        raise subprocess.CalledProcessError(result.returncode, cmd)
-    result_text = result.stdout.decode()
-    tool_output_cache[cmd_str] = result_text
-    return result_text
+    lines = [] if cache else None
+    # stderr goes to a file rather than a pipe so that a tool writing a lot of
+    # diagnostics can't block while stdout is being read.
+    with tempfile.TemporaryFile() as stderr:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr,
+                              text=True, errors='replace') as proc:
+            for line in proc.stdout:
+                if cache:
+                    lines.append(line)
+                yield line
+        if proc.returncode:
+            print(f'Command Failed:')
+            print(' '.join([str(p) for p in cmd]))
+            if cache:
+                print(''.join(lines))
+            stderr.seek(0)
+            print(stderr.read().decode(errors='replace'))
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    if not cache:
+        return
+    with cache_lock:
+        tool_output_cache[cmd_str] = lines
+    if disk_key is not None:
+        WriteDiskCache(disk_key, lines)
 
 
-def GetSymSizes(wasm):
-    bloaty = BLOATY_DIR / 'bloaty'
-    bloaty_output = run_tool([bloaty, '-d', 'symbols', '-n', '0',
-                              '--demangle=none', '--csv', wasm])
+WASM_MAGIC = b'\0asm'
+WASM_CUSTOM_SECTION = 0
+WASM_IMPORT_SECTION = 2
+WASM_CODE_SECTION = 10
+WASM_DATA_SECTION = 11
+WASM_FUNCTION_NAMES = 1
+WASM_DATA_SEGMENT_NAMES = 9
+
+def ReadLEB(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def ReadWasmName(data, pos):
+    length, pos = ReadLEB(data, pos)
+    end = pos + length
+    return data[pos:end].decode(errors='replace'), end
+
+
+def SkipWasmLimits(data, pos):
+    flags, pos = ReadLEB(data, pos)
+    _, pos = ReadLEB(data, pos) # min
+    if flags & 1:
+        _, pos = ReadLEB(data, pos) # max
+    return pos
+
+
+def SkipWasmInitExpr(data, pos):
+    while True:
+        opcode = data[pos]
+        pos += 1
+        if opcode == 0x0b: # end
+            return pos
+        if opcode in (0x23, 0x41, 0x42): # global.get, i32.const, i64.const
+            _, pos = ReadLEB(data, pos)
+
+
+def CountWasmFunctionImports(data, pos):
+    func_imports = 0
+    count, pos = ReadLEB(data, pos)
+    for _ in range(count):
+        _, pos = ReadWasmName(data, pos) # module
+        _, pos = ReadWasmName(data, pos) # field
+        kind = data[pos]
+        pos += 1
+        if kind == 0: # function
+            _, pos = ReadLEB(data, pos)
+            func_imports += 1
+        elif kind == 1: # table
+            pos = SkipWasmLimits(data, pos + 1)
+        elif kind == 2: # memory
+            pos = SkipWasmLimits(data, pos)
+        elif kind == 3: # global
+            pos += 2
+        elif kind == 4: # tag
+            _, pos = ReadLEB(data, pos + 1)
+    return func_imports
+
+
+def ReadWasmNameMap(data, pos, names):
+    count, pos = ReadLEB(data, pos)
+    for _ in range(count):
+        index, pos = ReadLEB(data, pos)
+        name, pos = ReadWasmName(data, pos)
+        names[index] = sys.intern(name)
+
+
+# Returns a dict of symbol name to size for the functions and data segments in
+# the wasm file, read directly from its code, data and name sections. Like
+# bloaty, the size of a function or data segment includes its header, and ones
+# without a name are called 'func[N]' or 'data[N]'. Returns None if the file has
+# no name section.
+def ReadWasmSymSizes(wasm):
+    func_imports = 0
+    func_sizes = []
+    data_sizes = []
+    func_names = {}
+    data_names = {}
+    has_names = False
+    with open(wasm, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 8:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] != WASM_MAGIC:
+                return None
+            pos = 8
+            while pos < len(data):
+                section_id = data[pos]
+                size, pos = ReadLEB(data, pos + 1)
+                section_end = pos + size
+                if section_id == WASM_IMPORT_SECTION:
+                    func_imports = CountWasmFunctionImports(data, pos)
+                elif section_id == WASM_CODE_SECTION:
+                    count, pos = ReadLEB(data, pos)
+                    for _ in range(count):
+                        start = pos
+                        body_size, pos = ReadLEB(data, pos)
+                        pos += body_size
+                        func_sizes.append(pos - start)
+                elif section_id == WASM_DATA_SECTION:
+                    count, pos = ReadLEB(data, pos)
+                    for _ in range(count):
+                        start = pos
+                        flags, pos = ReadLEB(data, pos)
+                        if flags == 2: # active, with memory index
+                            _, pos = ReadLEB(data, pos)
+                        if flags != 1: # not passive
+                            pos = SkipWasmInitExpr(data, pos)
+                        init_size, pos = ReadLEB(data, pos)
+                        pos += init_size
+                        data_sizes.append(pos - start)
+                elif section_id == WASM_CUSTOM_SECTION:
+                    name, pos = ReadWasmName(data, pos)
+                    if name == 'name':
+                        has_names = True
+                        while pos < section_end:
+                            subsection_id = data[pos]
+                            subsection_size, pos = ReadLEB(data, pos + 1)
+                            if subsection_id == WASM_FUNCTION_NAMES:
+                                ReadWasmNameMap(data, pos, func_names)
+                            elif subsection_id == WASM_DATA_SEGMENT_NAMES:
+                                ReadWasmNameMap(data, pos, data_names)
+                            pos += subsection_size
+                pos = section_end
+    if not has_names:
+        return None
+
     sym_sizes = {}
-    total_size = 0
-    for line in bloaty_output.split('\n'):
-        #print(line)
-        if (line.startswith('[section') or line.endswith('filesize') or
-            line.startswith('[WASM Header') or len(line) == 0):
-            continue
-        #print(line)
-        name, vmsize, filesize = line.split(',')
-        total_size += int(filesize)
-        sym_sizes[name] = int(filesize)
+    # Function names are indexed in the function index space, which starts
+    # with the imported functions.
+    # Entries missing from the name section are still counted (so that they
+    # are part of the total), named the same way bloaty names them.
+    for i, size in enumerate(func_sizes, func_imports):
+        name = func_names.get(i) or f'func[{i}]'
+        sym_sizes[name] = sym_sizes.get(name, 0) + size
+    for i, size in enumerate(data_sizes):
+        name = data_names.get(i) or f'data[{i}]'
+        sym_sizes[name] = sym_sizes.get(name, 0) + size
+    return sym_sizes
+
+
+# bloaty rows for parts of the file that aren't symbols.
+BLOATY_SKIP_PREFIXES = ('[section', '[WASM Header')
+
+def GetBloatySymSizes(wasm):
+    bloaty = BLOATY_DIR / 'bloaty'
+    bloaty_output = iter_tool_lines([bloaty, '-d', 'symbols', '-n', '0',
+                                     '--demangle=none', '--csv', wasm])
+    # Names containing commas are quoted, so use a real CSV parser.
+    reader = csv.reader(bloaty_output)
+    next(reader, None) # Skip the header
+    return {sys.intern(row[0]): int(row[2]) for row in reader
+            if row and not row[0].startswith(BLOATY_SKIP_PREFIXES)}
+
+
+def GetSymSizes(wasm):
+    sym_sizes = ReadWasmSymSizes(wasm)
+    if sym_sizes is None:
+        if VERBOSE:
+            print(f'No name section in {wasm}, falling back to bloaty')
+        sym_sizes = GetBloatySymSizes(wasm)
+    total_size = sum(sym_sizes.values())
 
     print(f'{len(sym_sizes)} symbols in {wasm} ({total_size:,} bytes)')
-    return sym_sizes
+    return sym_sizes, total_size
+
+
+# Data segment names in the linked wasm are the data symbol names with one of
+# these prefixes.
+DATA_PREFIXES = ('.rodata.', '.data.')
+LOCAL_DATA_PREFIXES = tuple(prefix + '.L' for prefix in DATA_PREFIXES)
 
+# datas holds the names of the lib's data symbols with each of DATA_PREFIXES,
+# i.e. as they appear in the linked wasm, so they can be matched directly.
+LibSymbols = namedtuple('LibSymbols',
+                        ['funcs', 'weaks', 'datas', 'local_datas'])
 
-def GetLibFunctions(libs):
+# The output isn't cached, since it's only parsed once per run and GetLibSymbols
+# caches the parsed symbols of each lib on disk instead.
+def RunNm(libs):
     nm = LLVM_DIR / 'llvm-nm'
-    func_names = set()
-    weak_names = set()
-    data_names = {}
-    local_data_names = set()
+    return iter_tool_lines([nm, '--defined-only', '--format=posix', '--no-sort',
+                            '--print-file-name', *libs],
+                           cache=False)
+
+
+# Returns a dict mapping each lib in libs to its LibSymbols. Each lib's symbols
+# are cached on disk, keyed by the lib, so only libs that changed since the last
+# run are read. By default those are read by a single llvm-nm invocation; with
+# --print-file-name every output line is prefixed with the file it came from (or
+# 'archive[member]' for archive members), which attributes the symbol to its
+# lib.
+def GetLibSymbols(libs):
+    # The same file (typically an archive) can be given more than once, e.g.
+    # through different relative paths or symlinks. Only read each file once.
+    # Archive members don't need to be listed separately, since the
+    # --print-file-name output already names the member of each symbol.
+    unique_libs = {}
     for lib in libs:
-        functions = 0
-        weaks = 0
-        datas = 0
-        local_datas = 0
-        nm_output = run_tool([nm, lib])
-        for line in nm_output.split('\n'):
-            try:
-                addr, symtype, name = line.split()
-                #print(f'type {symtype}, name {name}')
-                if symtype.lower() == 't': # A global or local defined function sym
-                    func_names.add(name)
-                    functions += 1
-                elif symtype.lower() == 'w': # A global or local weak symbol
-                    weak_names.add(name)
-                    weaks += 1
-                elif symtype.lower() == 'd':
-                    #if name in data_names and not name.startswith('.L') and  not 'piecewise_construct' in name:
-                    #    print(f'Warning: duplicate data name {name} in {lib} and {data_names[name]}')
-                    if name.startswith('.L'):
-                        local_data_names.add(name)
-                        local_datas += 1
-                    else:
-                        data_names[name] = lib
-                        datas += 1
-            except ValueError: # fewer than 3 tokens
+        unique_libs.setdefault(os.path.realpath(lib), lib)
+    nm = LLVM_DIR / 'llvm-nm'
+    lib_symbols = {}
+    lib_keys = {}
+    for lib in unique_libs.values():
+        key = (GetDiskCacheKey(['LibSymbols', nm, lib]) if USE_DISK_CACHE
+               else None)
+        symbols = ReadDiskCache(key) if key is not None else None
+        if symbols is not None:
+            # Unpickled strings aren't interned, so intern them again.
+            lib_symbols[lib] = LibSymbols(*(set(map(sys.intern, names))
+                                            for names in symbols))
+        else:
+            lib_keys[lib] = key
+
+    read_libs = list(lib_keys)
+    lib_paths = {str(lib): lib for lib in read_libs}
+    for lib in read_libs:
+        lib_symbols[lib] = LibSymbols(set(), set(), set(), set())
+    if PARALLEL_NM and len(read_libs) > 1:
+        # subprocess releases the GIL while waiting, so threads are enough to
+        # run the tools in parallel. The outputs are parsed on this thread.
+        with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1,
+                                                len(read_libs))) as executor:
+            nm_outputs = list(executor.map(lambda lib: list(RunNm([lib])),
+                                           read_libs))
+    elif read_libs:
+        nm_outputs = [RunNm(read_libs)]
+    else:
+        nm_outputs = []
+    for nm_lines in nm_outputs:
+        ParseNmOutput(nm_lines, lib_paths, lib_symbols)
+    for lib, key in lib_keys.items():
+        if key is not None:
+            WriteDiskCache(key, tuple(lib_symbols[lib]))
+    if VERBOSE:
+        for lib, symbols in lib_symbols.items():
+            datas = len(symbols.datas) // len(DATA_PREFIXES)
+            print(f'{len(symbols.funcs)} functions, {len(symbols.weaks)} weak '
+                  f'symbols, and {datas} data symbols in {lib}')
+    for lib in libs:
+        if lib not in lib_symbols:
+            lib_symbols[lib] = lib_symbols[unique_libs[os.path.realpath(lib)]]
+    return lib_symbols
+
+
+def ParseNmOutput(nm_lines, lib_paths, lib_symbols):
+    for line in nm_lines:
+        path, _, sym = line.partition(': ')
+        lib = lib_paths.get(path)
+        if lib is None:
+            lib = lib_paths.get(path.rpartition('[')[0])
+            if lib is None:
                 continue
-        if VERBOSE:
-            print(f'{functions} functions, {weaks} weak symbols, and {data} data symbols in {lib}')
-    return func_names, weak_names, data_names, local_data_names
-
-
-LibSize = namedtuple('LibSize', ['name', 'function', 'weak', 'data', 'local'])
-
-def GetLibSize(libs, sym_sizes):
-    lib_size = 0
-    lib_weak_size = 0
-    lib_data_size = 0
-    local_data_size = 0
-    lib_funcs, lib_weaks, lib_datas, lib_local_datas = GetLibFunctions(libs)
-    for sym, size in sym_sizes.items():
-        if sym in lib_funcs:
-            lib_size += size
-        elif sym in lib_weaks:
-            lib_weak_size += size
-        if sym.startswith('.rodata') or sym.startswith('.data'):
-            stripped_name = sym.removeprefix('.rodata.').removeprefix('.data.')
-            if stripped_name in lib_datas:
-                lib_data_size += size
-            elif stripped_name.startswith('.L'):
-                local_data_size += size
-    name = libs[0].name if len(libs) == 1 else '(aggregate)'
+        symbols = lib_symbols[lib]
+        # POSIX format has fixed fields: 'name type value size'
+        name, _, rest = sym.partition(' ')
+        symtype = rest[:1].lower()
+        # The same names appear in several libs and in the linked wasm's
+        # symbols; interning them shares the strings and speeds up lookups.
+        name = sys.intern(name)
+        #print(f'type {symtype}, name {name}')
+        if symtype == 't': # A global or local defined function sym
+            symbols.funcs.add(name)
+        elif symtype == 'w': # A global or local weak symbol
+            symbols.weaks.add(name)
+        elif symtype == 'd':
+            #if name in data_names and not name.startswith('.L') and  not 'piecewise_construct' in name:
+            #    print(f'Warning: duplicate data name {name} in {lib} and {data_names[name]}')
+            if name.startswith('.L'):
+                symbols.local_datas.add(name)
+            else:
+                symbols.datas.update(sys.intern(prefix + name)
+                                     for prefix in DATA_PREFIXES)
+
+
+# Combines several LibSymbols into one, deduplicating the symbols.
+def MergeLibSymbols(all_symbols):
+    merged = LibSymbols(set(), set(), set(), set())
+    for symbols in all_symbols:
+        merged.funcs.update(symbols.funcs)
+        merged.weaks.update(symbols.weaks)
+        merged.datas.update(symbols.datas)
+        merged.local_datas.update(symbols.local_datas)
+    return merged
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class LibSize:
+    name: str
+    function: int
+    weak: int
+    data: int
+    local: int
+
+
+# Local (.L) data symbols can't be attributed to a lib, so their size is the
+# same for every lib.
+def GetLocalDataSize(sym_sizes):
+    return sum(size for sym, size in sym_sizes.items()
+               if sym.startswith(LOCAL_DATA_PREFIXES))
+
+
+def GetLibSize(name, lib_symbols, sym_sizes):
+    lib_funcs, lib_weaks, lib_datas, lib_local_datas = lib_symbols
+    # Intersect the symbol sets rather than testing every symbol from Python.
+    # Weak symbols that the lib also defines strongly are only counted once.
+    sym_names = sym_sizes.keys()
+    lib_size = sum(map(sym_sizes.__getitem__, sym_names & lib_funcs))
+    lib_weak_size = sum(map(sym_sizes.__getitem__,
+                            (sym_names & lib_weaks) - lib_funcs))
+    lib_data_size = sum(map(sym_sizes.__getitem__, sym_names & lib_datas))
+    local_data_size = GetLocalDataSize(sym_sizes)
     return LibSize(name, lib_size, lib_weak_size, lib_data_size, local_data_size)
 
 
+# Returns the LibSize of each of libs. Rather than calling GetLibSize for each
+# lib (a pass over sym_sizes per lib), this maps each symbol name to the libs
+# defining it and joins that with sym_sizes once.
+def GetLibSizes(libs, lib_symbols, sym_sizes):
+    # Each name maps to the (lib index, kind) of every definition of it, so
+    # that function, weak and data symbols are all found with one lookup.
+    FUNCTION, WEAK, DATA = range(3)
+    sym_libs = {}
+    for i, lib in enumerate(libs):
+        symbols = lib_symbols[lib]
+        for kind, names in ((FUNCTION, symbols.funcs),
+                            (WEAK, symbols.weaks - symbols.funcs),
+                            (DATA, symbols.datas)):
+            for name in names:
+                sym_libs.setdefault(name, []).append((i, kind))
+
+    sizes = [[0] * len(libs) for _ in range(3)]
+    # Join the linked symbols with the lib symbols by intersecting the dict
+    # key views, so that only the matching symbols are visited from Python.
+    for sym in sym_sizes.keys() & sym_libs.keys():
+        size = sym_sizes[sym]
+        for i, kind in sym_libs[sym]:
+            sizes[kind][i] += size
+    local_data_size = GetLocalDataSize(sym_sizes)
+    return [LibSize(lib.name, sizes[FUNCTION][i], sizes[WEAK][i],
+                    sizes[DATA][i], local_data_size)
+            for i, lib in enumerate(libs)]
+
+
+# Returns the LibSize of each of libs, and the deduplicated LibSize of all of
+# them together. The results are also cached on disk, keyed by the libs and
+# linked_wasm, so when only a few libs have changed since the last run only
+# those are sized again (and GetLibSymbols only runs llvm-nm on those).
+def GetAllLibSizes(libs, linked_wasm, sym_sizes):
+    nm = LLVM_DIR / 'llvm-nm'
+    if USE_DISK_CACHE:
+        lib_keys = [GetDiskCacheKey(['LibSize', nm, lib, linked_wasm])
+                    for lib in libs]
+        deduped_key = GetDiskCacheKey(['DedupedLibSize', nm, *libs,
+                                       linked_wasm])
+    else:
+        lib_keys = [None] * len(libs)
+        deduped_key = None
+    cached = {}
+    for key in [*lib_keys, deduped_key]:
+        if key is not None:
+            value = ReadDiskCache(key)
+            if value is not None:
+                cached[key] = value
+
+    missing = [lib for lib, key in zip(libs, lib_keys) if key not in cached]
+    deduped_size = (LibSize('(aggregate)', *cached[deduped_key])
+                    if deduped_key in cached else None)
+    # The deduplicated size needs the symbols of every lib, but those of
+    # unchanged libs come from GetLibSymbols' cache.
+    lib_symbols = GetLibSymbols(missing if deduped_size is not None else libs)
+    new_sizes = iter(GetLibSizes(missing, lib_symbols, sym_sizes))
+    # Only the sizes are cached, since the cache is keyed by resolved path and
+    # the lib may have been named differently (e.g. via a symlink) before.
+    sizes = [LibSize(lib.name, *cached[key]) if key in cached
+             else next(new_sizes) for lib, key in zip(libs, lib_keys)]
+    if deduped_size is None:
+        deduped_size = GetLibSize('(aggregate)',
+                                  MergeLibSymbols(lib_symbols.values()),
+                                  sym_sizes)
+
+    for key, size in [*zip(lib_keys, sizes), (deduped_key, deduped_size)]:
+        if key is not None and key not in cached:
+            WriteDiskCache(key, (size.function, size.weak, size.data,
+                                 size.local))
+    return sizes, deduped_size
+
+
 def GetDataSize(sym_sizes):
     data_sym_count = 0
     data_size = 0
@@ -141,16 +600,12 @@ def main(args):
     libs = [Path(f) for f in args[:-1]]
     linked_wasm = Path(args[-1])
 
-    sym_sizes = GetSymSizes(linked_wasm)
-    linked_sym_size = sum(size for sym, size in sym_sizes.items())
+    sym_sizes, linked_sym_size = GetSymSizes(linked_wasm)
     data_sym_count, data_sym_size = GetDataSize(sym_sizes)
     #print(f'Total symbols size in {linked_wasm}: {linked_sym_size:,}')
     print(f'{data_sym_count} data symbols ({data_sym_size:,} bytes)')
 
-    sizes = []
-
-    for lib in libs:
-        sizes.append(GetLibSize([lib], sym_sizes))
+    sizes, deduped_size = GetAllLibSizes(libs, linked_wasm, sym_sizes)
     sizes.sort(key=lambda i: i.function + i.weak, reverse=True)
 
     def Percent(s):
@@ -173,8 +628,8 @@ def main(args):
 
     libs_size_sum = sum(lib.function for lib in sizes)
     # To calculate weak symbols properly, we want each weak symbol to be counted
-    # only once globally, rather than once per input/library. So, run the calculation
-    # again, but with all of the inputs together (which deduplicates all symbols).
+    # only once globally, rather than once per input/library. So, deduped_size is
+    # calculated with all of the inputs together (which deduplicates all symbols).
     # It seems to happen in some
     # cases that the sum of the strongly-defined function sizes in the libs is
     # also larger than the deduplicated total (this shouldn't be true if the inputs
@@ -182,7 +637,6 @@ def main(args):
     # as this would result in a multiple definition error). Warn in this case.
     # Probably there is some inaccuracy in this script, or perhaps some object
     # file was generated but not actually included in the link.
-    deduped_size = GetLibSize(libs, sym_sizes)
     if libs_size_sum != deduped_size.function:
         print(f'warning: sum of strong definition sizes from all inputs is {libs_size_sum}, deduplicated total is {deduped_size.function}')
     #assert total_size.function == libs_size